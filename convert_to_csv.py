@@ -3,134 +3,230 @@
 Convert OSM data from JSON files to CSV files.
 
 For each element:
-- Skip elements with only id, type, and lat/lon (geometry-only)
-- For ways: get lat/lon from first node in the elements array
+- Skip elements with only id, type, and lat/lon (geometry-only) or tagged religion=no/none
+- For ways: get lat/lon from the first point of their geometry
+  (files saved before the query used `out geom` fall back to the first node in the elements array)
 - Add query_purpose (filename) and query_county (folder name)
 - Flatten all tags into columns
 
 Output: Either one combined CSV file or separate CSV files by query type in data/csv/
 Set CREATE_SEPARATE_CSV_FILES = True in main() to create separate files, False for combined file.
+Set WRITE_PARQUET = True in main() to also write a .parquet file next to each CSV file.
 
 Run using `uv run --script convert_to_csv.py`
 """
 
-import json
+import os
+import orjson
 import pandas as pd
+import pyarrow as pa
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from pyarrow import parquet as pq
 from query_osm import COUNTIES, QUERIES
 
+# Tags that make an element worth keeping on their own
+MEANINGFUL_KEYS = frozenset({'name', 'amenity', 'shop', 'building', 'leisure', 'religion',
+                             'phone', 'website', 'addr:housenumber', 'addr:street',
+                             'addr:city', 'email', 'opening_hours'})
 
-def create_node_lookup(elements):
-    """
-    Create a lookup dict for node coordinates from the elements array.
-    Returns dict: node_id -> (lat, lon)
-    """
-    lookup = {}
-    for element in elements:
-        if element.get('type') == 'node' and 'lat' in element and 'lon' in element:
-            lookup[element['id']] = (element['lat'], element['lon'])
-    return lookup
+# Tag prefixes that carry no useful information about the place itself
+NOISE_PREFIXES = ('source', 'gnis', 'wikidata', 'wikipedia', 'note', 'fixme')
+
+# Low-cardinality columns stored as pandas categoricals
+CATEGORICAL_COLUMNS = ('query_county', 'query_purpose', 'osm_type', 'religion', 'amenity', 'building', 'shop')
 
+# Columns taken from the element itself rather than its tags
+ELEMENT_COLUMNS = ('latitude', 'longitude', 'query_purpose', 'query_county', 'osm_id', 'osm_type')
 
-def should_include_element(element, node_lookup):
+
+def should_include_element(tags):
     """
-    Determine if element should be included.
+    Determine if an element with the given tags should be included.
     Skip elements that only have id, type, and basic geometry.
     """
-    # Must have meaningful tags beyond just basic identification
-    tags = element.get('tags', {})
-
     # Skip if no tags at all
     if not tags:
         return False
 
+    # Skip places explicitly marked as having no religion
+    if tags.get('religion') in ('no', 'none'):
+        return False
+
     # Check for at least one meaningful tag
-    meaningful_keys = {'name', 'amenity', 'shop', 'building', 'leisure', 'religion',
-                      'phone', 'website', 'addr:housenumber', 'addr:street',
-                      'addr:city', 'email', 'opening_hours'}
+    if not MEANINGFUL_KEYS.isdisjoint(tags):
+        return True
 
-    for key in tags.keys():
-        if key in meaningful_keys or not key.startswith(('source', 'gnis', 'wikidata',
-                                                         'wikipedia', 'note', 'fixme')):
+    # Otherwise any tag outside the noise prefixes is enough
+    for key in tags:
+        if not key.startswith(NOISE_PREFIXES):
             return True
 
     return False
 
 
-def get_element_coordinates(element, node_lookup):
+def set_column_value(columns, row_index, key, value):
     """
-    Extract latitude and longitude from element.
-    For nodes: use their lat/lon directly.
-    For ways: use coordinates of first node from lookup.
+    Set the value of column `key` for row `row_index` in a dict of column lists.
+    New columns and rows this column skipped are backfilled with None.
     """
-    elem_type = element.get('type')
-
-    if elem_type == 'node':
-        return element.get('lat'), element.get('lon')
-    elif elem_type == 'way':
-        # For ways, get coordinates from first node
-        nodes = element.get('nodes', [])
-        if nodes:
-            lat_lon = node_lookup.get(nodes[0])
-            if lat_lon:
-                return lat_lon[0], lat_lon[1]
-
-    return None, None
+    column = columns.get(key)
+    if column is None:
+        column = columns[key] = []
 
+    if len(column) > row_index:
+        column[row_index] = value
+        return
+    if len(column) < row_index:
+        column.extend([None] * (row_index - len(column)))
+    column.append(value)
 
-def extract_element_data(element, node_lookup, query_purpose, query_county):
-    """
-    Extract all relevant data from a single element.
-    Returns a dict with flattened data ready for DataFrame.
-    """
-    lat, lon = get_element_coordinates(element, node_lookup)
 
-    data_row = {
-        'latitude': lat,
-        'longitude': lon,
-        'query_purpose': query_purpose,
-        'query_county': query_county,
-        'osm_id': element.get('id'),
-        'osm_type': element.get('type')
-    }
+def pad_columns(columns, row_count):
+    """Backfill every column list with None up to row_count."""
+    for column in columns.values():
+        if len(column) < row_count:
+            column.extend([None] * (row_count - len(column)))
 
-    # Add all tags as individual columns
-    tags = element.get('tags', {})
-    for key, value in tags.items():
-        data_row[key] = value
 
-    return data_row
+def extend_columns(columns, row_count, other, other_count):
+    """
+    Append the rows of another dict of column lists to `columns`.
+    Returns the new row count.
+    """
+    for key, values in other.items():
+        column = columns.get(key)
+        if column is None:
+            column = columns[key] = []
+        if len(column) < row_count:
+            column.extend([None] * (row_count - len(column)))
+        column.extend(values)
+    return row_count + other_count
 
 
 def process_json_file(filepath, query_purpose, query_county):
     """
-    Process a single JSON file and return list of data rows.
+    Process a single JSON file and return (columns, row_count), where columns
+    maps each column name to a list of row_count values.
+
+    Elements are visited once and included elements are appended as rows
+    immediately. Ways carry their own geometry (`out geom`); for older files
+    without it, ways are patched from the node coordinates in a short second pass.
     """
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-
-        elements = data.get('elements', [])
-        node_lookup = create_node_lookup(elements)
+        with open(filepath, 'rb') as f:
+            data = orjson.loads(f.read())
+
+        node_lookup = {}
+        pending_ways = []
+        columns = {}
+        row_count = 0
+        for element in data.get('elements', []):
+            elem_type = element.get('type')
+            if elem_type == 'node' and 'lat' in element and 'lon' in element:
+                node_lookup[element['id']] = (element['lat'], element['lon'])
+
+            tags = element.get('tags')
+            if not should_include_element(tags):
+                continue
 
-        rows = []
-        for element in elements:
-            if should_include_element(element, node_lookup):
-                row_data = extract_element_data(element, node_lookup, query_purpose, query_county)
-                rows.append(row_data)
+            # For nodes use their lat/lon directly, for ways use their first point
+            lat = lon = None
+            if elem_type == 'node':
+                lat, lon = element.get('lat'), element.get('lon')
+            elif elem_type == 'way':
+                geometry = element.get('geometry')
+                nodes = element.get('nodes')
+                if geometry and geometry[0]:
+                    lat, lon = geometry[0]['lat'], geometry[0]['lon']
+                elif nodes:
+                    lat_lon = node_lookup.get(nodes[0])
+                    if lat_lon:
+                        lat, lon = lat_lon
+                    else:
+                        pending_ways.append((row_count, nodes[0]))
+
+            set_column_value(columns, row_count, 'latitude', lat)
+            set_column_value(columns, row_count, 'longitude', lon)
+            set_column_value(columns, row_count, 'query_purpose', query_purpose)
+            set_column_value(columns, row_count, 'query_county', query_county)
+            set_column_value(columns, row_count, 'osm_id', element.get('id'))
+            set_column_value(columns, row_count, 'osm_type', elem_type)
+
+            # Add all tags as individual columns
+            for key, value in tags.items():
+                set_column_value(columns, row_count, key, value)
+            row_count += 1
+
+        # Older `>; out skel` responses list way nodes after the ways, so resolve those now
+        for row_index, node_id in pending_ways:
+            lat_lon = node_lookup.get(node_id)
+            if lat_lon:
+                columns['latitude'][row_index], columns['longitude'][row_index] = lat_lon
 
-        print(f"Processed {filepath} ({len(rows)} elements with meaningful data)")
-        return rows
+        pad_columns(columns, row_count)
+        print(f"Processed {filepath} ({row_count} elements with meaningful data)")
+        return columns, row_count
 
     except Exception as e:
         print(f"Error processing {filepath}: {e}")
-        return []
+        return {}, 0
+
+
+def _process_one(task):
+    """Unpack a (filepath, query_purpose, query_county) task for the process pool."""
+    return process_json_file(*task)
+
+
+def build_dataframe(columns):
+    """
+    Build a DataFrame from a dict of column lists and add the blank columns
+    expected in the output.
+    """
+    # OSM tag values are always strings, so give tag columns their dtype up
+    # front instead of letting pandas infer it from every value
+    data = {}
+    for key, values in columns.items():
+        if key in CATEGORICAL_COLUMNS:
+            data[key] = pd.Categorical(values)
+        elif key in ELEMENT_COLUMNS:
+            data[key] = values
+        else:
+            data[key] = pd.array(values, dtype='string')
+    df = pd.DataFrame(data, copy=False)
+
+    # Add blank columns to match more closely to expected columns
+    df['Collaborated'] = ''
+    df['city'] = ''
+    df['person_with_relationship'] = ''
+    df['org_contact'] = ''
+    df['org_contact_title'] = ''
+
+    return df
+
+
+def get_column_order(columns):
+    """
+    Order columns with the specified columns first, then the remaining tag
+    columns alphabetically with addr:* last.
+    Returns (col_order, tag_columns).
+    """
+    priority_cols = ['name', 'Collaborated', 'query_county', 'city', 'query_purpose', 'person_with_relationship', 'org_contact', 'org_contact_title', 'phone', 'email', 'contact:email', 'website']
+    remaining_base_cols = ['latitude', 'longitude', 'osm_id', 'osm_type']
+    base_cols = priority_cols + remaining_base_cols
+    base_col_set = set(base_cols)
+    other_cols = [col for col in columns if col not in base_col_set]
+    col_order = base_cols + sorted(other_cols, key=lambda x: (x.startswith('addr:'), x))
+    return col_order, other_cols
 
 
 def main():
     """Main function to process all JSON files and create CSV files."""
     # Set to True to create separate CSV files by query type, False to create one combined CSV file
     CREATE_SEPARATE_CSV_FILES = True
+    # Set to True to also write a Parquet file next to each CSV file
+    WRITE_PARQUET = True
 
     data_dir = Path("data")
     if not data_dir.exists():
@@ -142,90 +238,101 @@ def main():
 
     print("Starting data conversion to CSV...")
 
-    # Collect all data
-    all_data = []
+    # Collect (json_file, query_purpose, query_county) tasks
+    tasks = []
 
-    # Process each county directory
-    for county_dir in sorted(data_dir.iterdir()):
-        if not county_dir.is_dir():
-            continue
+    # Process each county directory; scandir entries cache their type, so no extra stat per entry
+    with os.scandir(data_dir) as it:
+        county_entries = sorted((entry for entry in it if entry.is_dir()), key=lambda entry: entry.name)
 
+    for county_dir in county_entries:
         query_county = county_dir.name
         if query_county not in COUNTIES:
             print(f"Skipping unknown county directory: {query_county}")
             continue
 
-        print(f"\nProcessing county: {query_county}")
+        print(f"Found county: {query_county}")
+
+        # Queue each JSON file in county directory
+        with os.scandir(county_dir.path) as it:
+            json_entries = sorted((entry for entry in it if entry.name.endswith('.json')), key=lambda entry: entry.name)
 
-        # Process each JSON file in county directory
-        for json_file in sorted(county_dir.glob("*.json")):
-            query_purpose = json_file.stem  # filename without .json extension
+        for json_file in json_entries:
+            query_purpose = json_file.name[:-len('.json')]  # filename without .json extension
             if query_purpose not in QUERIES:
                 print(f"Skipping unknown query file: {query_purpose}")
                 continue
 
-            rows = process_json_file(json_file, query_purpose, query_county)
-            all_data.extend(rows)
+            tasks.append((json_file.path, query_purpose, query_county))
+
+    # Each file is independent, so parse them in parallel across cores.
+    # Rows are bucketed by purpose so each DataFrame only spans its own tags;
+    # each bucket is a dict of column lists rather than a list of row dicts.
+    print(f"\nProcessing {len(tasks)} files...")
+    buckets = defaultdict(dict)
+    row_counts = defaultdict(int)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for (_, query_purpose, _), (columns, row_count) in zip(tasks, executor.map(_process_one, tasks)):
+            row_counts[query_purpose] = extend_columns(buckets[query_purpose], row_counts[query_purpose],
+                                                       columns, row_count)
+
+    for query_purpose, columns in buckets.items():
+        pad_columns(columns, row_counts[query_purpose])
 
     # Create CSV files
-    if not all_data:
+    if not any(row_counts.values()):
         print("No data to convert!")
         return
 
-    df_all = pd.DataFrame(all_data)
-
-    # Filter out rows where religion column is 'no' or 'none'
-    religion_mask = ~df_all['religion'].isin(['no', 'none'])
-    df_all = df_all[religion_mask]
-
-    # Add blank columns to match more closely to expected columns 
-    df_all['Collaborated'] = ''
-    df_all['city'] = ''
-    df_all['person_with_relationship'] = ''
-    df_all['org_contact'] = ''
-    df_all['org_contact_title'] = ''
-
-    # Reorder columns to put specified columns first
-    priority_cols = ['name', 'Collaborated', 'query_county', 'city', 'query_purpose', 'person_with_relationship', 'org_contact', 'org_contact_title', 'phone', 'email', 'contact:email', 'website']
-    remaining_base_cols = ['latitude', 'longitude', 'osm_id', 'osm_type']
-    other_cols = [col for col in df_all.columns if col not in priority_cols + remaining_base_cols]
-    col_order = priority_cols + remaining_base_cols + sorted(other_cols, key=lambda x: (x.startswith('addr:'), x))
-
-    # For dropping empty tag columns later
-    tag_columns = other_cols
-
     total_rows = 0
     csv_files_created = 0
 
     if CREATE_SEPARATE_CSV_FILES:
-        # Group by query_purpose and create separate CSV files
-        purpose_groups = df_all.groupby('query_purpose')
+        # Create separate CSV files by query_purpose
+        summary_frames = []
 
-        for purpose, group_df in purpose_groups:
-            # Reorder columns and sort
-            group_df = group_df[col_order]
-            group_df = group_df.sort_values(['query_county', 'osm_id'])
+        for purpose in sorted(buckets):
+            if not row_counts[purpose]:
+                continue
 
-            # Drop tag columns that are completely empty (all NaN or empty strings)
-            columns_to_drop = []
-            for col in tag_columns:
-                if col in group_df.columns and (group_df[col].isna() | (group_df[col] == '')).all():
-                    columns_to_drop.append(col)
+            group_df = build_dataframe(buckets[purpose])
+            col_order, tag_columns = get_column_order(group_df.columns)
 
-            if columns_to_drop:
-                group_df = group_df.drop(columns=columns_to_drop)
-                print(f"Dropped {len(columns_to_drop)} empty tag columns from {purpose}")
+            # Find tag columns that are completely empty (all NaN or empty strings)
+            # first, so reordering and dropping them is a single reindex
+            tag_df = group_df[tag_columns]
+            has_values = (tag_df.notna() & (tag_df != '')).any()
+            empty_tags = set(has_values.index[~has_values])
+
+            # Reorder columns without the empty tag columns and sort
+            group_df = group_df.reindex(columns=[col for col in col_order if col not in empty_tags])
+            group_df = group_df.sort_values(['query_county', 'osm_id'])
+
+            if empty_tags:
+                print(f"Dropped {len(empty_tags)} empty tag columns from {purpose}")
 
             # Export to CSV
             csv_path = csv_dir / f"{purpose}.csv"
             group_df.to_csv(csv_path, index=False)
             print(f"Created {csv_path} ({len(group_df)} rows, {len(group_df.columns)} columns)")
 
+            if WRITE_PARQUET:
+                parquet_path = csv_path.with_suffix(".parquet")
+                table = pa.Table.from_pandas(group_df, preserve_index=False)
+                pq.write_table(table, parquet_path, compression='snappy', use_dictionary=True)
+                print(f"Created {parquet_path}")
+
+            summary_frames.append(group_df[['query_purpose', 'query_county']])
             total_rows += len(group_df)
             csv_files_created += 1
+
+        df_all = pd.concat(summary_frames, ignore_index=True)
     else:
         # Create single combined CSV file
-        df_all = df_all[col_order]
+        df_all = pd.concat([build_dataframe(buckets[purpose]) for purpose in sorted(buckets) if row_counts[purpose]],
+                           ignore_index=True)
+        col_order, _ = get_column_order(df_all.columns)
+        df_all = df_all.reindex(columns=col_order)
         df_all = df_all.sort_values(['query_county', 'query_purpose', 'osm_id'])
 
         # Export to CSV (back to original location)
@@ -233,6 +340,12 @@ def main():
         df_all.to_csv(csv_path, index=False)
         print(f"Created {csv_path} ({len(df_all)} rows)")
 
+        if WRITE_PARQUET:
+            parquet_path = csv_path.with_suffix(".parquet")
+            table = pa.Table.from_pandas(df_all, preserve_index=False)
+            pq.write_table(table, parquet_path, compression='snappy', use_dictionary=True)
+            print(f"Created {parquet_path}")
+
         total_rows = len(df_all)
         csv_files_created = 1
 
@@ -241,8 +354,9 @@ def main():
     print(f"Total rows across all files: {total_rows}")
 
     # Show summary stats
-    purpose_counts = df_all.groupby('query_purpose').size()
-    county_counts = df_all.groupby('query_county').size()
+    # Group keys are sorted once on the small result via sort_index()
+    purpose_counts = df_all.groupby('query_purpose', sort=False, observed=True).size().sort_index()
+    county_counts = df_all.groupby('query_county', sort=False, observed=True).size().sort_index()
 
     print("\nData by purpose:")
     for purpose, count in purpose_counts.items():
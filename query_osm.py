@@ -3,9 +3,10 @@
 Run using `uv run --script query_osm.py`
 """
 
+import asyncio
 import httpx
-import json
-import time
+import os
+import random
 from pathlib import Path
 
 # County OSM relation IDs
@@ -17,6 +18,9 @@ COUNTIES = {
     "santa_clara": "3600396501"
 }
 
+# Overpass allows about two concurrent query slots per IP
+MAX_CONCURRENT_QUERIES = 2
+
 # Query tags by category
 QUERIES = {
     "religion": [
@@ -55,47 +59,97 @@ QUERIES = {
     ]
 }
 
-def build_overpass_query(relation_id, tags):
-    """Build Overpass API query string for area union of tags."""
-    area_part = f"area({relation_id})->.searchArea;"
-    tag_parts = "\n  ".join([f"nwr[{tag}](area.searchArea);" for tag in tags])
-    query = f"[out:json];\n{area_part}\n(\n  {tag_parts}\n);\nout body;\n>;\nout skel qt;"
-    return query
+# Union of tag conditions per category, built once and shared by every county
+CATEGORY_BODY = {
+    category: "\n  ".join(f"nwr[{tag}](area.searchArea);" for tag in tags)
+    for category, tags in QUERIES.items()
+}
 
-def query_overpass(query_str, max_retries=5):
-    """Execute Overpass query with retry logic and exponential backoff."""
+def build_overpass_query(relation_id, category):
+    """Build Overpass API query string for area union of the category's tags."""
+    # `out geom` inlines each way's coordinates, so member nodes need no separate recursion
+    return f"[out:json];\narea({relation_id})->.searchArea;\n(\n  {CATEGORY_BODY[category]}\n);\nout geom;"
+
+def retry_delay(attempt, response=None):
+    """
+    Seconds to wait before retrying, randomized so parallel queries don't
+    retry in lockstep: the server's Retry-After header plus up to 50% if it
+    sent one, otherwise exponential backoff +/-50%.
+    """
+    delay = 2 ** attempt  # 1s, 2s, 4s, 8s, 16s
+    if response is not None and 'Retry-After' in response.headers:
+        try:
+            retry_after = int(response.headers['Retry-After'])
+        except ValueError:
+            pass  # HTTP-date form, keep exponential backoff
+        else:
+            # Never retry before the server said we may
+            return random.uniform(retry_after, retry_after * 1.5)
+    return random.uniform(delay * 0.5, delay * 1.5)
+
+async def query_overpass(client, query_str, label, filepath, max_retries=5):
+    """
+    Execute Overpass query with retry logic and exponential backoff.
+    The response body is streamed to a temporary file that is renamed to
+    filepath once complete. Returns the number of bytes saved, or None on failure.
+    """
     url = "https://overpass-api.de/api/interpreter"
+    tmp_path = filepath.with_name(filepath.name + ".tmp")
 
     for attempt in range(max_retries):
         try:
-            print(f"Making request (attempt {attempt + 1}/{max_retries})...")
-            response = httpx.post(url, data=query_str, timeout=60)
-
-            if response.status_code == 200:
-                return response.json()
-            elif response.status_code >= 500 or response.status_code == 429:
-                # Server error or rate limit, retry
-                delay = 2 ** attempt  # 1s, 2s, 4s, 8s, 16s
-                print(f"Server/rate limit error {response.status_code}, retrying in {delay}s...")
-                time.sleep(delay)
-            else:
-                # Other client error, don't retry
-                print(f"Client error {response.status_code}: {response.text}")
-                return None
+            print(f"{label} Making request (attempt {attempt + 1}/{max_retries})...")
+            request = client.build_request("POST", url, data=query_str, timeout=60)
+            # Stream so error bodies (often large HTML pages) are only read when needed
+            response = await client.send(request, stream=True)
+
+            try:
+                if response.status_code == 200:
+                    # Write the raw JSON as it arrives instead of parsing and re-encoding it
+                    size = 0
+                    with open(tmp_path, 'wb') as f:
+                        async for chunk in response.aiter_bytes(1 << 20):
+                            f.write(chunk)
+                            size += len(chunk)
+                    os.replace(tmp_path, filepath)
+                    return size
+                elif response.status_code >= 500 or response.status_code == 429:
+                    # Server error or rate limit, retry
+                    delay = retry_delay(attempt, response)
+                    print(f"{label} Server/rate limit error {response.status_code}, retrying in {delay:.1f}s...")
+                    await asyncio.sleep(delay)
+                else:
+                    # Other client error, don't retry
+                    await response.aread()
+                    print(f"{label} Client error {response.status_code}: {response.text}")
+                    return None
+            finally:
+                await response.aclose()
 
         except Exception as e:
-            delay = 2 ** attempt if attempt < max_retries - 1 else 0
-            print(f"Request failed: {e}")
+            tmp_path.unlink(missing_ok=True)
+            delay = retry_delay(attempt) if attempt < max_retries - 1 else 0
+            print(f"{label} Request failed: {e}")
             if delay > 0:
-                print(f"Retrying in {delay}s...")
-                time.sleep(delay)
+                print(f"{label} Retrying in {delay:.1f}s...")
+                await asyncio.sleep(delay)
             else:
                 break
 
-    print("Max retries exceeded")
+    print(f"{label} Max retries exceeded")
     return None
 
-def main():
+async def fetch_category(client, semaphore, label, query_str, filepath):
+    """Run one Overpass query once a slot is free and save the result to filepath."""
+    async with semaphore:
+        size = await query_overpass(client, query_str, label, filepath)
+
+    if size is not None:
+        print(f"{label} ✓ Saved {size / 1e6:.1f} MB to {filepath}")
+    else:
+        print(f"{label} ✗ Failed to retrieve data")
+
+async def main():
     """Query OSM data for all counties and categories, save to JSON files."""
     data_dir = Path("data")
     data_dir.mkdir(exist_ok=True)
@@ -103,41 +157,34 @@ def main():
 
     total_queries = len(COUNTIES) * len(QUERIES)
     completed = 0
+    pending = []
 
     for county, relation_id in COUNTIES.items():
         for category, tags in QUERIES.items():
-            print(f"\n[{completed + 1}/{total_queries}] Querying {county} {category}...")
-
-            # Build query
-            query_str = build_overpass_query(relation_id, tags)
-            print(f"Query has {len(tags)} tag conditions")
+            completed += 1
+            label = f"[{completed}/{total_queries}] {county} {category}:"
 
             # Check if file already exists in subdir
             county_dir = data_dir / county
             county_dir.mkdir(exist_ok=True)
             filepath = county_dir / f"{category}.json"
             if filepath.exists():
-                print(f"Already exists, skipping")
-                completed += 1
+                print(f"{label} Already exists, skipping")
                 continue
 
-            # Execute query
-            result = query_overpass(query_str)
-
-            if result:
-                # Save to file
-                with open(filepath, 'w', encoding='utf-8') as f:
-                    json.dump(result, f, indent=2, ensure_ascii=False)
-
-                elements_count = len(result.get('elements', []))
-                print(f"✓ Saved {elements_count} elements to {filepath}")
-            else:
-                print("✗ Failed to retrieve data")
+            # Build query
+            query_str = build_overpass_query(relation_id, category)
+            print(f"{label} Query has {len(tags)} tag conditions")
+            pending.append((label, query_str, filepath))
 
-            completed += 1
+    # Execute queries concurrently, bounded to the slots Overpass allows
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_QUERIES)
+    async with httpx.AsyncClient() as client:
+        await asyncio.gather(*(fetch_category(client, semaphore, label, query_str, filepath)
+                               for label, query_str, filepath in pending))
 
     print("\nAll queries completed!")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())